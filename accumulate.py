@@ -1,11 +1,13 @@
 import os
 import numpy as np
-from math import ceil
 import multiprocessing
 import pandas as pd
 import sys
-from dataclasses import dataclass, field, asdict, make_dataclass
-from memoize.dataframe import memoize_df
+from numba import njit, prange
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from dataclasses import dataclass, field, asdict, make_dataclass, fields
+from typing import Dict, Tuple
 
 sys.path.append(os.path.realpath('src'))
 
@@ -14,16 +16,195 @@ from ubacktester import (
     ClockBase, downsample_to_pow
 )
 from profiler import profiler
+from feather_cache import memoize_feather
 
+# Columns to read from the trades CSV, and the arrow type to parse each as.
+# Side is written as a float (e.g. "-1.0"), and is cast to int after reading.
+TRADES_COLUMN_TYPES = {
+    'timestamp_utc_nanoseconds': pa.int64(),
+    'PriceMillionths': pa.int64(),
+    'SizeBillionths': pa.int64(),
+    'Side': pa.float64(),
+}
+
+
+@njit(cache=True)
+def _fill_qualified(is_qual, side_sign, price, start, end, buy_max, sell_min):
+    for j in range(start, end):
+        if side_sign[j] > 0:
+            is_qual[j] = price[j] == buy_max
+        else:
+            is_qual[j] = price[j] == sell_min
+
+
+@njit(parallel=True, cache=True)
+def mark_qualified(ts, side_sign, price, pow10):
+    """
+    Downsample sorted timestamps `ts` (see `downsample_to_pow`) and mark
+    qualifying trades. Within each downsample bucket, qualifying trades are
+    those at the max price for buys and the min price for sells. Buckets
+    do not overlap, so they are processed in parallel.
+    Returns the `dt_ds` and `is_qual` arrays.
+    """
+    n = len(ts)
+    unit = 10 ** pow10
+    step = unit // 10
+    dt_ds = np.empty(n, dtype=np.int64)
+    is_qual = np.zeros(n, dtype=np.int8)
+    for i in prange(n):
+        dt_ds[i] = (ts[i] // step + 9) // 10 * unit
+    if n == 0:
+        return dt_ds, is_qual
+
+    # Index of the first trade in each bucket, plus an end sentinel
+    starts = np.concatenate((
+        np.zeros(1, dtype=np.int64),
+        np.nonzero(dt_ds[1:] != dt_ds[:-1])[0] + 1,
+        np.full(1, n, dtype=np.int64),
+    ))
+    for k in prange(len(starts) - 1):
+        start = starts[k]
+        end = starts[k + 1]
+        buy_max = np.iinfo(np.int64).min
+        sell_min = np.iinfo(np.int64).max
+        for i in range(start, end):
+            if side_sign[i] > 0:
+                buy_max = max(buy_max, price[i])
+            else:
+                sell_min = min(sell_min, price[i])
+        _fill_qualified(is_qual, side_sign, price, start, end, buy_max, sell_min)
+    return dt_ds, is_qual
+
+
+# Names of the columns returned by `accumulate_trades`, in order
+ACCUMULATE_COLS = (
+    'cum_volm_side', 'cum_volm_opp', 'cum_volm_all', 'cum_volm_qual', 'target_prt',
+    'target_prt_cumsum', 'notional', 'notional_cumsum', 'vwap', 'fees',
+    'market_vwap',
+)
+
+
+@njit(cache=True)
+def accumulate_trades(side, price, size, is_qual, own_side, target_prt_rate, fee_rate):
+    """
+    Calculate the running volumes, target participation, notional, fees,
+    and VWAPs of the accumulate strategy in a single forward pass over the
+    trades. Returns one array per column in `ACCUMULATE_COLS`:
+
+    - cum_volm_side: cumulative volume of trades on side `own_side`
+    - cum_volm_opp: cumulative volume of trades on the opposite side
+    - cum_volm_all: cumulative volume of all trades
+    - cum_volm_qual: cumulative volume of qualifying trades on side `own_side`
+    - target_prt: size that we trade alongside each qualifying trade
+    - target_prt_cumsum: cumulative `target_prt`
+    - notional: notional value of `target_prt`
+    - notional_cumsum: cumulative `notional`
+    - vwap: VWAP of our trades to date, NaN before our first trade
+    - fees: fees on `notional`, truncated to int
+    - market_vwap: VWAP of all trades to date, NaN while volume is zero
+    """
+    n = len(price)
+    cum_volm_side = np.empty(n, dtype=np.int64)
+    cum_volm_opp = np.empty(n, dtype=np.int64)
+    cum_volm_all = np.empty(n, dtype=np.int64)
+    cum_volm_qual = np.empty(n, dtype=np.int64)
+    target_prt = np.empty(n)
+    target_prt_cumsum = np.empty(n)
+    notional = np.empty(n)
+    notional_cumsum = np.empty(n)
+    vwap = np.full(n, np.nan)
+    fees = np.empty(n, dtype=np.int64)
+    market_vwap = np.full(n, np.nan)
+
+    volm_same = 0
+    volm_opp = 0
+    volm_all = 0
+    volm_qual = 0
+    prt_sum = 0.
+    notional_sum = 0.
+    mkt_notional_sum = 0.
+    for i in range(n):
+        same_side = side[i] * own_side > 0
+        qual = same_side and is_qual[i] != 0
+        if same_side:
+            volm_same += size[i]
+        else:
+            volm_opp += size[i]
+        volm_all += size[i]
+        if qual:
+            volm_qual += size[i]
+        cum_volm_side[i] = volm_same
+        cum_volm_opp[i] = volm_opp
+        cum_volm_all[i] = volm_all
+        cum_volm_qual[i] = volm_qual
+
+        target_prt[i] = (1. if qual else 0.) * target_prt_rate * size[i]
+        prt_sum += target_prt[i]
+        target_prt_cumsum[i] = prt_sum
+
+        notional[i] = target_prt[i] * (price[i] / 1e6)
+        notional_sum += notional[i]
+        notional_cumsum[i] = notional_sum
+        if prt_sum != 0.:
+            vwap[i] = notional_sum / prt_sum
+        fees[i] = int(notional[i] * fee_rate / 1e4)
+
+        mkt_notional_sum += size[i] * (price[i] / 1e6)
+        if volm_all != 0:
+            market_vwap[i] = mkt_notional_sum / volm_all
+    return (
+        cum_volm_side, cum_volm_opp, cum_volm_all, cum_volm_qual, target_prt,
+        target_prt_cumsum, notional, notional_cumsum, vwap, fees,
+        market_vwap,
+    )
+
+
+# Columns of the trades DataFrame that are stored in each `TradesSoA` field
+TRADES_SOA_COLUMNS = {
+    'price': 'PriceMillionths',
+    'size': 'SizeBillionths',
+    'side': 'Side',
+    'dt_ds': 'dt_ds',
+    'is_qual': 'is_qual',
+}
+
+
+@dataclass
+class TradesSoA:
+    """
+    Trades stored as one contiguous 1D numpy array per column, in order of
+    `dt`. `get_trades_data` (and its Feather cache) still returns a
+    DataFrame; use `from_df` to convert it.
+    """
+    dt: np.ndarray
+    price: np.ndarray
+    size: np.ndarray
+    side: np.ndarray
+    dt_ds: np.ndarray
+    is_qual: np.ndarray
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame) -> 'TradesSoA':
+        dt = df['dt'] if 'dt' in df.columns else df.index
+        return cls(
+            dt=np.ascontiguousarray(dt, dtype=np.int64),
+            **{
+                name: np.ascontiguousarray(df[col])
+                for name, col in TRADES_SOA_COLUMNS.items()
+            }
+        )
+
+    def __len__(self) -> int:
+        return len(self.dt)
+
+    def __getitem__(self, key) -> 'TradesSoA':
+        """Index every array with `key`, e.g. a slice."""
+        return TradesSoA(**{f.name: getattr(self, f.name)[key] for f in fields(self)})
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        """Get a dict of the arrays, keyed by trades DataFrame column."""
+        return {col: getattr(self, name) for name, col in TRADES_SOA_COLUMNS.items()}
 
-def downsample_to_pow(val: int, pow10: int = 6) -> int:
-    n = pow10 + 1
-    hi, lo = str(val)[:-n], str(val)[-n:]
-    roundup = lambda x: int(ceil(x / 10.0)) * 10
-    suffix = str(roundup(int(lo[:2])))[0] + (pow10 * '0')
-    final = int(hi + suffix)
-    assert len(str(final)) == len(str(val))
-    return final
 
 class InsufficientRowsError(Exception):
     pass
@@ -40,65 +221,145 @@ class AccumulateRunner(dict):
 
     # @profiler()
     def mark_qualified_trades(self, df: pd.DataFrame) -> pd.DataFrame:
-        df['dt_ds'] = (
-            pd.Series(df.index, dtype=np.int64)
-            .apply(downsample_to_pow, args=[self.downsample_rate])
-            .values
-        )
         df['Side'] = df['Side'].replace(0, -1 * self.side)
         try:
             df['side_sign'] = (df['Side'] / df['Side'].abs()).astype(int)
         except pd.errors.IntCastingNaNError:
             raise
-        grp = df.groupby(['dt_ds', 'side_sign'], group_keys=False).apply(self._mark_qualified)
-        grp.index.name = 'dt'
-        grp.drop(columns='side_sign', inplace=True)
-        # breakpoint()
-        return grp
-
-    def _mark_qualified(self, df):
-        if len(df) == 1:
-            df['is_qual'] = 1
-            return df
-        side = df['side_sign'].iloc[0]
-        # assert (df['side_sign'] == side).all()
-        if side > 0:
-            qual_price = df['PriceMillionths'].max()
-        else:
-            qual_price = df['PriceMillionths'].min()
-        qualified_mask = df['PriceMillionths'] == qual_price
-        df['is_qual'] = qualified_mask.astype(int)
-        # breakpoint()
+        assert df.index.is_monotonic_increasing, "trades must be sorted by dt"
+        assert self.downsample_rate >= 1, f"{self.downsample_rate=} must be at least 1"
+        df['dt_ds'], df['is_qual'] = mark_qualified(
+            ts=np.asarray(df.index, dtype=np.int64),
+            side_sign=df['side_sign'].values,
+            price=df['PriceMillionths'].values.astype(np.int64),
+            pow10=self.downsample_rate,
+        )
+        df.index.name = 'dt'
+        df.drop(columns='side_sign', inplace=True)
         return df
 
-    @memoize_df(cache_dir='data/memoize', cache_lifetime_days=None)
+    @staticmethod
+    def _trades_csv_options() -> Dict:
+        return dict(
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(TRADES_COLUMN_TYPES),
+                column_types=TRADES_COLUMN_TYPES,
+            ),
+        )
+
+    @classmethod
+    def _read_trades_csv(cls, fp) -> pa.Table:
+        """Read the columns in `TRADES_COLUMN_TYPES` from the trades CSV at `fp`."""
+        return pacsv.read_csv(fp, **cls._trades_csv_options())
+
+    @classmethod
+    def _read_trades_window(
+        cls, fp, start_date_ns, row_limit, pow10,
+    ) -> Tuple[pa.Table, bool]:
+        """
+        Stream the trades CSV at `fp` in batches, keeping only the trades
+        needed to mark the first `row_limit` trades at or after
+        `start_date_ns`: those trades, plus the other trades in the
+        downsample buckets (see `downsample_to_pow`) that they fall in, so
+        that they are marked the same as when marking the whole file.
+        While the file is sorted by timestamp, reading stops once the
+        bucket of the last of those trades is complete. This assumes that
+        a file whose first batches are sorted is sorted throughout.
+        Returns the trades and whether they are every trade in the file.
+        """
+        reader = pacsv.open_csv(fp, **cls._trades_csv_options())
+        start_ds = downsample_to_pow(start_date_ns, pow10)
+        row_limit = max(int(row_limit), 1)
+        batches = list()
+        is_full = True
+        is_sorted = True
+        last_ts = np.iinfo(np.int64).min
+        nrows = 0
+        end_ds = None
+        for batch in reader:
+            if not batch.num_rows:
+                continue
+            ts = batch.column('timestamp_utc_nanoseconds').to_numpy()
+            is_sorted = is_sorted and ts[0] >= last_ts and bool((ts[1:] >= ts[:-1]).all())
+            last_ts = ts[-1]
+            dt_ds = downsample_to_pow(ts, pow10)
+            keep = dt_ds >= start_ds
+            if not keep.all():
+                is_full = False
+                batch = batch.filter(pa.array(keep))
+                ts = ts[keep]
+                dt_ds = dt_ds[keep]
+            batches.append(batch)
+            if not is_sorted or not len(ts):
+                continue
+
+            # Bucket of the `row_limit`-th trade at or after `start_date_ns`
+            if end_ds is None:
+                in_window = np.flatnonzero(ts >= start_date_ns)
+                if nrows + len(in_window) >= row_limit:
+                    end_ds = dt_ds[in_window[row_limit - nrows - 1]]
+                nrows += len(in_window)
+            if end_ds is not None and dt_ds[-1] > end_ds:
+                return pa.Table.from_batches(batches, schema=reader.schema), False
+        return pa.Table.from_batches(batches, schema=reader.schema), is_full
+
     def get_trades_data(
         self, fp, downsample_rate, side, start_date_ns,
         row_limit,
     ):
-        df = pd.read_csv(fp, delim_whitespace=True)
+        """
+        Get up to `row_limit` marked trades (see `mark_qualified_trades`)
+        starting at `start_date_ns`. Sliced from the memoized trades for the
+        whole file (see `_load_and_mark`) if they are cached. Otherwise,
+        only reads as much of the file as is needed (see
+        `_read_trades_window`), and caches the trades for the whole file
+        only if that turns out to be all of it.
+        """
+        load_kw = dict(fp=fp, downsample_rate=downsample_rate, side=side)
+        if os.path.isfile(type(self)._load_and_mark.cache_path(self, **load_kw)):
+            df = self._load_and_mark(**load_kw)
+        else:
+            tbl, is_full = self._read_trades_window(
+                fp, start_date_ns, row_limit, pow10=self.downsample_rate)
+            df = self._mark_trades_table(tbl, fp)
+            if is_full:
+                type(self)._load_and_mark.write_cache(df, self, **load_kw)
+        return df.loc[start_date_ns:].iloc[:int(row_limit)]
+
+    @memoize_feather(cache_dir='data/memoize')
+    def _load_and_mark(self, fp, downsample_rate, side):
+        """
+        Load all trades in `fp` and mark qualifying trades. Memoized on
+        only the args that change the result, so that different
+        `start_date_ns` and `row_limit` reuse the same cached trades.
+        """
+        return self._mark_trades_table(self._read_trades_csv(fp), fp)
+
+    def _mark_trades_table(self, tbl: pa.Table, fp) -> pd.DataFrame:
+        """Convert trades `tbl` read from `fp` to a DataFrame, and mark it."""
+        df = tbl.to_pandas(split_blocks=True, self_destruct=True)
+        del tbl
+        df = df.astype({'Side': np.int16}, copy=False)
         df.rename(columns={
             'timestamp_utc_nanoseconds': 'dt',
         }, inplace=True)
-        df.sort_values(by='dt', inplace=True)
-        df['Side'] = df['Side'].astype(int)
-        print(
-            f"Dates in trades data {fp=} range between "
-            f"{df['dt'].min()} ({pd.to_datetime(df['dt'].min())}) and "
-            f"{df['dt'].max()} ({pd.to_datetime(df['dt'].max())})"
-        )
-        df.drop(columns=['received_utc_nanoseconds'], inplace=True)
+        df.sort_values(by='dt', inplace=True, kind='stable')
+        if not df.empty:
+            print(
+                f"Dates in trades data {fp=} read between "
+                f"{df['dt'].min()} ({pd.to_datetime(df['dt'].min())}) and "
+                f"{df['dt'].max()} ({pd.to_datetime(df['dt'].max())})"
+            )
         # assert not (df['Side'] == 0).any()
         # df = df[df['Side'] / side > 0]
         df.set_index('dt', inplace=True)
-        df = df.loc[start_date_ns:].iloc[:int(row_limit)]
         df = self.mark_qualified_trades(df)
-        df = df.convert_dtypes()
         # breakpoint()
         return df
 
     # @profiler()
-    # @memoize_df(cache_dir='data/memoize', cache_lifetime_days=None)
+    # @memoize_feather(cache_dir='data/memoize')
     def run_accumulate_strat(
         self, fp,
         start_date='1970-01-01', # trim data starting at this date
@@ -109,74 +370,60 @@ class AccumulateRunner(dict):
         side=1,
     ):
         start_date_ns = pd.to_datetime(start_date, unit='ns').value
-        df = self.get_trades_data(
+        trades = TradesSoA.from_df(self.get_trades_data(
             fp=fp, downsample_rate=self.downsample_rate, side=self.side,
             start_date_ns=start_date_ns, row_limit=row_limit,
-        )
-        df = df.convert_dtypes()
-        if 'dt' in df.columns:
-            df.set_index('dt', inplace=True)
-
-        # Define masks for same side and qualifying trades
-        same_side = df['Side'] * self.side > 0
-        qual_mask = same_side & df['is_qual']
+        ))
 
         # Calculate cumulative volume over time for each side, for all trades,
-        # and for qualifying trades.
-        df.loc[same_side, 'cum_volm_side'] = df.loc[same_side, 'SizeBillionths'].cumsum()
-        df.loc[~same_side, 'cum_volm_side'] = df.loc[~same_side, 'SizeBillionths'].cumsum()
-        df['cum_volm_all'] = df.loc[:, 'SizeBillionths'].cumsum()
-        df['cum_volm_qual'] = pd.NA
-        df.loc[qual_mask, 'cum_volm_qual'] = df.loc[qual_mask, 'SizeBillionths'].cumsum()
-        df = df.convert_dtypes()
-
-        # Calculate target participation for each qualifying trade (billionths).
-        # In theory, the below calculation should get us the same as
-        # df['cum_volm_qual'] * target_prt_rate. They're not exactly equal
-        # due to the rounding we do with astype(int)
-        df['target_prt'] = (same_side.astype(int) * df['is_qual'] * target_prt_rate * df['SizeBillionths'])
-        df['target_prt_cumsum'] = df['target_prt'].cumsum()
-        # Approximately equal:
-        # df['target_prt_cumsum'] = (df['cum_volm_qual'] * target_prt_rate).astype(int)
-
-        # Calculate notional (billionths), fees (billionths), and VWAP
-        df['notional'] = (df['target_prt'] * (df['PriceMillionths'] / 1e6))
-        # df['notional_cumsum'] = df['notional'].cumsum().astype(int)
-        try:
-            df['vwap'] = df['notional'].cumsum().div(df['target_prt'].cumsum().replace(0., pd.NA))
-        except ZeroDivisionError:
-            raise
-        df['fees'] = (df['notional'] * fee_rate / 1e4).astype(int)
-        # df['market_vwap'] = (
-        #     (df['SizeBillionths'] * (df['PriceMillionths'] / 1e6)).cumsum() /
-        #     (df['SizeBillionths']).cumsum())
-
-        df['since_arrival'] = df['dt_ds'] - df['dt_ds'].iloc[0]
+        # and for qualifying trades, along with target participation,
+        # notional (billionths), fees (billionths), and VWAP. See
+        # `accumulate_trades` for the definition of each column.
+        cols = dict(zip(ACCUMULATE_COLS, accumulate_trades(
+            side=trades.side,
+            price=trades.price.astype(np.int64, copy=False),
+            size=trades.size.astype(np.int64, copy=False),
+            is_qual=trades.is_qual.astype(np.int8, copy=False),
+            own_side=self.side,
+            target_prt_rate=float(target_prt_rate),
+            fee_rate=float(fee_rate),
+        )))
 
         # DEBUG
         # df['market_vwap_side'] = (
         #     (df.loc[same_side, 'SizeBillionths'] * (df.loc[same_side, 'PriceMillionths'] / 1e6)).cumsum() /
         #     (df.loc[same_side, 'SizeBillionths']).cumsum())
-        vwap = (
-            (df['SizeBillionths'] * (df['PriceMillionths'] / 1e6)).sum() /
-            (df['SizeBillionths']).sum())
+        if len(trades):
+            vwap = (trades.size * (trades.price / 1e6)).sum() / trades.size.sum()
         # print(f'{vwap=}')
         # assert not (df['market_vwap'] > df['vwap']).sum()
         # if vwap < df['vwap'].iloc[-1]:
         #     print(f"Warning: {(df['market_vwap'] > df['vwap']).sum()}")
 
-        traded_notional = df['notional'].sum() / 1e9
-        if traded_notional < target_notional:
-            # Raise error if we haven't reached target_notional
+        notional_cumsum = cols['notional_cumsum']
+        traded_notional = notional_cumsum[-1] / 1e9 if len(notional_cumsum) else 0.
+        if not len(trades) or traded_notional < target_notional:
+            # Raise error if we haven't reached target_notional, or if there
+            # are no trades at all
             raise InsufficientRowsError(
                 f"{traded_notional=} {target_notional=}"
             )
         else:
-            # Trim dataframe once we've reached target_notional
-            last_trade = df[df['notional'].cumsum() / 1e9 > target_notional].iloc[0]
-            last_idx = int(last_trade.name)
-            df = df.loc[:last_idx]
-        return df
+            # Trim dataframe once we've reached target_notional.
+            # notional_cumsum is non-decreasing, so binary search for the
+            # first trade that takes us past the target.
+            cutoff = np.searchsorted(
+                notional_cumsum, target_notional * 1e9, side='right')
+            last_idx = trades.dt[min(cutoff, len(trades) - 1)]
+            # Keep all trades up to and including `last_idx`, like .loc
+            end = np.searchsorted(trades.dt, last_idx, side='right')
+            trades = trades[:end]
+            cols = {col: arr[:end] for col, arr in cols.items()}
+
+        # Only build a DataFrame for the caller once all columns are final
+        cols = {**trades.to_columns(), **cols}
+        cols['since_arrival'] = trades.dt_ds - trades.dt_ds[0]
+        return pd.DataFrame(cols, index=pd.Index(trades.dt, name='dt'))
 
 def accumulate_runner_wrapper(
     start_date,
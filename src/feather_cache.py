@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import inspect
+from functools import wraps
+from typing import Callable, Optional
+import pandas as pd
+from pyarrow import feather
+
+
+def memoize_feather(cache_dir: str = 'data/memoize',
+                    compression: Optional[str] = 'zstd') -> Callable:
+    """Memoizes a function that returns a pandas DataFrame, saving the
+    result as a Feather v2 file in `cache_dir`. This function returns a
+    decorator, so use like:
+    @memoize_feather(cache_dir='data/memoize')
+    def my_func(fp, row_limit):
+        return pd.read_csv(fp).iloc[:row_limit]
+
+    The cache key is a hash of the function name and its bound arguments
+    (excluding `self`). Arguments that are paths to existing files also
+    contribute their modification time, so editing the input file
+    invalidates the cache. Cached files are loaded with `memory_map=True`.
+
+    The decorated function also has a `cache_path(*args, **kwargs)` method
+    that returns the path of the cache file for a call, and a
+    `write_cache(df, *args, **kwargs)` method that caches `df` as the
+    result of a call.
+    """
+
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        def cache_path(*args, **kwargs) -> str:
+            return os.path.join(cache_dir, f"{func.__name__}_{_cache_key(func, sig, args, kwargs)}.feather")
+
+        def write_cache(df: pd.DataFrame, *args, **kwargs):
+            assert isinstance(df, pd.DataFrame), (
+                f"memoize_feather can only cache DataFrames, not {type(df)}"
+            )
+            fp = cache_path(*args, **kwargs)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partially written cache file.
+            tmp_fp = f"{fp}.{os.getpid()}.tmp"
+            feather.write_feather(df, tmp_fp, compression=compression)
+            os.replace(tmp_fp, fp)
+
+        @wraps(func)
+        def with_cache(*args, **kwargs):
+            fp = cache_path(*args, **kwargs)
+            if os.path.isfile(fp):
+                return feather.read_feather(fp, memory_map=True)
+            df = func(*args, **kwargs)
+            write_cache(df, *args, **kwargs)
+            return df
+        with_cache.cache_path = cache_path
+        with_cache.write_cache = write_cache
+        return with_cache
+
+    return decorator
+
+
+def _cache_key(func: Callable, sig: inspect.Signature, args, kwargs, maxlen=16) -> str:
+    bound = sig.bind(*args, **kwargs)
+    bound.apply_defaults()
+    params = {k: v for k, v in bound.arguments.items() if k != 'self'}
+    mtimes = {
+        k: os.path.getmtime(v) for k, v in params.items()
+        if isinstance(v, str) and os.path.isfile(v)
+    }
+    d = dict(func=func.__qualname__, params=params, mtimes=mtimes)
+    return hashlib.sha1(
+        json.dumps(d, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()[:maxlen]
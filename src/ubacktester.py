@@ -8,7 +8,7 @@ import logging
 from typing import Dict, List, Optional, Union, Tuple, Callable, Any
 from datetime import datetime, date
 from dataclasses import dataclass, field, asdict, make_dataclass
-from math import sqrt, ceil
+from math import sqrt
 from numbers import Number
 import numpy as np
 import pandas as pd
@@ -36,6 +36,8 @@ DATE_COLS = ('date', 'dt', )
 # over time. It's a two-length tuple that contains the name
 # of the data feed and the field in that data feed that contains the value.
 FeedID = namedtuple('FeedID', ('name', 'field'))
+# Initial number of records that `FeedBase` buffers before growing its buffers
+RECORD_BUFFER_SIZE = 1024
 
 # -------------------------- Helpers & Utilities -------------------------------
 
@@ -57,6 +59,12 @@ def cls_name(self) -> str:
     return self.__class__.__name__
 
 
+def _get_callable(obj: Any, name: str) -> Union[Callable, None]:
+    """Get method `name` of `obj`, or None if it is not callable."""
+    attr = getattr(obj, name, None)
+    return attr if isinstance(attr, Callable) else None
+
+
 def infer_price_feed_id(symbol: str, feeds: Dict[str, Any]) -> Union[FeedID, None]:
     """
     Given a dict of `feeds`, attempts to find which feed contains price data.
@@ -140,13 +148,19 @@ class FeedBase():
         Return the list of records as a pandas DataFrame, indexed and sorted
         by datetime (`dt`).
 
-        Note: this is an expensive operation if feed has many fields and records.
+        If `before_dt` is True, only return records up to and including the
+        current `dt`. This slice is cached until `dt` or the records change.
         """
-        df = getattr(self, '_in_df')
-        if before_dt:
-            return getattr(self, '_in_df').loc[:self.dt, :]
-        else:
+        self._flush_record_buffers()
+        if not before_dt:
             return getattr(self, '_in_df')
+        cache = getattr(self, '_before_dt_cache', None)
+        if cache is None or not (cache[0] is self.dt or cache[0] == self.dt):
+            df = getattr(self, '_in_df')
+            stop = df.index.slice_locs(end=self.dt)[1]
+            cache = (self.dt, df.iloc[:stop])
+            self._before_dt_cache = cache
+        return cache[1]
 
     def __getitem__(self, *args, **kw):
         return self._get_df(before_dt=True).iloc.__getitem__(*args, **kw)
@@ -171,9 +185,21 @@ class FeedBase():
         ]
         return self._builtin_dtype_fields
 
+    def _get_record_fields(self) -> Tuple[str, ...]:
+        """
+        Names of the fields written by `record`, i.e. the builtin dtype fields
+        excluding the datetime, which is used as the index. Computed once.
+        """
+        if not hasattr(self, '_record_fields'):
+            self._record_fields = tuple(
+                name for name in self._get_builtin_dtype_fields()
+                if name not in DATE_COLS
+            )
+        return self._record_fields
+
     def record(self, allow_types=(Number, bool, str, np.datetime64, datetime, date)):
         """Record `self`'s attributes as a record and append it to `_records`."""
-        d = self.asdict()
+        d = {name: getattr(self, name) for name in self._get_record_fields()}
         self._append_to_in_df(d)
 
     def _append_to_in_df_slow(self, d: Dict):
@@ -186,13 +212,83 @@ class FeedBase():
         return self._in_df
 
     def _append_to_in_df(self, d: Dict):
+        """
+        Append record `d` at the current `dt`. The first record initializes
+        `_in_df`, which fixes its columns and dtypes. Later records are
+        written to column buffers (see `_buffer_record`), and are only
+        written to `_in_df` when it is next read.
+        """
         for key in DATE_COLS:
             if key in d:
                 del d[key]
         if not hasattr(self, '_in_df'):
             self._init_in_df(d)
-        self._in_df.loc[self.dt, :] = d
-        return self._in_df
+        self._buffer_record(d)
+        self._invalidate_records_cache()
+
+    def _buffer_record(self, d: Dict):
+        """
+        Write record `d` at the current `dt` to a set of column buffers: one
+        numpy array per field, doubled in size whenever it is full. Fields
+        with a float column in `_in_df` are stored as float64, with None as
+        NaN, and all others as object.
+        """
+        n = getattr(self, '_buf_n', 0)
+        if n and tuple(d.keys()) != self._buf_fields:
+            self._flush_record_buffers()
+            n = 0
+        if n == 0:
+            self._buf_fields = tuple(d.keys())
+            self._buf_dt = np.empty(RECORD_BUFFER_SIZE, dtype=object)
+            self._bufs = [
+                np.empty(RECORD_BUFFER_SIZE, dtype=self._buffer_dtype(name, val))
+                for name, val in d.items()
+            ]
+        elif n == len(self._buf_dt):
+            self._buf_dt = np.concatenate([self._buf_dt, np.empty_like(self._buf_dt)])
+            self._bufs = [np.concatenate([buf, np.empty_like(buf)]) for buf in self._bufs]
+
+        self._buf_dt[n] = self.dt
+        for j, val in enumerate(d.values()):
+            buf = self._bufs[j]
+            if buf.dtype.kind == 'f':
+                if val is None:
+                    val = np.nan
+                elif isinstance(val, (bool, np.bool_)) or not isinstance(val, Number):
+                    buf = self._bufs[j] = buf.astype(object)
+            buf[n] = val
+        self._buf_n = n + 1
+
+    def _buffer_dtype(self, name: str, val: Any) -> type:
+        """
+        Buffer dtype for field `name`. Uses the dtype of its column in
+        `_in_df` if there is one, so that a None value does not turn a float
+        column into object, otherwise the type of its value `val`.
+        """
+        if name in self._in_df.columns:
+            is_float = self._in_df[name].dtype.kind == 'f'
+        else:
+            is_float = isinstance(val, (float, np.floating))
+        return np.float64 if is_float else object
+
+    def _flush_record_buffers(self):
+        """Write all buffered records to `_in_df` and empty the buffers."""
+        n = getattr(self, '_buf_n', 0)
+        if not n:
+            return
+        self._buf_n = 0
+        rows = pd.DataFrame(
+            data={name: buf[:n] for name, buf in zip(self._buf_fields, self._bufs)},
+            index=pd.Index(self._buf_dt[:n].tolist()),
+        ).infer_objects()
+        # Later records at the same `dt` overwrite earlier ones
+        rows = rows[~rows.index.duplicated(keep='last')]
+        rows = rows.reindex(columns=self._in_df.columns)
+        is_new = ~rows.index.isin(self._in_df.index)
+        if not is_new.all():
+            self._in_df.loc[rows.index[~is_new], :] = rows[~is_new]
+        if is_new.any():
+            self._in_df = pd.concat([self._in_df, rows[is_new]])
 
     def _init_in_df(self, d: Dict):
         if hasattr(self, 'clock'):
@@ -249,17 +345,59 @@ class FeedBase():
         else:
             return True
 
+    def _get_records_cache(self) -> Tuple[pd.Index, Dict[str, List]]:
+        """
+        Returns the index of `_in_df` and a dict of each of its columns as a
+        list. Cached until the records change, so that looking up a single
+        record does not need to slice or convert the whole DataFrame.
+        """
+        cache = getattr(self, '_records_cache', None)
+        if cache is None:
+            self._flush_record_buffers()
+            df = self._in_df
+            cache = (df.index, {col: df[col].tolist() for col in df.columns})
+            self._records_cache = cache
+        return cache
+
+    def _invalidate_records_cache(self):
+        """Reset cached views of `_in_df`. Call whenever the records change."""
+        self._records_cache = None
+        self._before_dt_cache = None
+
+    def _get_record(self, i: int) -> Dict:
+        """Get the record at integer position `i` of `_in_df` as a dict."""
+        _, cols = self._get_records_cache()
+        return {col: vals[i] for col, vals in cols.items()}
+
+    def _prev_record_loc(self) -> int:
+        """
+        Integer position of the last record where the datetime is less than
+        or equal to the current `dt`, or -1 if there is no such record.
+        Same semantics as `.loc[:dt]`, using a binary search on the index.
+        """
+        index, _ = self._get_records_cache()
+        return index.slice_locs(end=self.dt)[1] - 1
+
+    def _next_record_loc(self) -> int:
+        """
+        Integer position of the first record where the datetime is greater
+        than or equal to the current `dt`. Equal to the number of records if
+        there is no such record.
+        """
+        index, _ = self._get_records_cache()
+        return index.slice_locs(start=self.dt)[0]
+
     def get_prev(self) -> Dict:
         """
         Get the last record where the datetime is less than or equal to
         the current `dt`.
         """
-        as_dict = self.df.loc[:self.dt, :].to_dict(orient='records')
-        assert as_dict, (
+        i = self._prev_record_loc()
+        assert i >= 0, (
             f"no records before {self.dt} exist in instance "
             f"of {cls_name(self)} (first is {self.df.index[0]})"
         )
-        last_dict = as_dict[-1]
+        last_dict = self._get_record(i)
         if not self.in_df_bounds():
             for k in last_dict:
                 last_dict[k] = None
@@ -270,12 +408,12 @@ class FeedBase():
         Get the next record where the datetime is greater than or equal to
         the current `dt`.
         """
-        as_dict = self.df.loc[self.dt:, :].to_dict(orient='records')
-        assert as_dict, (
+        i = self._next_record_loc()
+        assert i < len(self.df), (
             f"no records after {self.dt} exist in instance "
             f"of {cls_name(self)} (latest is {self.df.index[-1]})"
         )
-        first_dict = as_dict[0]
+        first_dict = self._get_record(i)
         if not self.in_df_bounds():
             for k in first_dict:
                 first_dict[k] = None
@@ -294,11 +432,40 @@ class FeedBase():
     def set_from_prev_in_df(self):
         # Get last row of _in_df
         # last_row = self._in_df[self._in_df.dt <= self.dt].iloc[-1, :].to_dict()
-        last_row = self[-1, :].to_dict()
+        i = self._prev_record_loc()
+        if i < 0:
+            raise IndexError(
+                f"no records before {self.dt} exist in instance of {cls_name(self)}"
+            )
+        last_row = self._get_record(i)
         if 'dt' in last_row:
             del last_row['dt']
         self._set_from_dict(last_row)
 
+    def values_on_clock(self, dti: Union[pd.DatetimeIndex, pd.Index]) -> pd.DataFrame:
+        """
+        Get the records of `self` as seen by strategies at every step of a
+        backtest over clock `dti`. Strategies see a feed as of the previous
+        step of the clock, or the first record on the first step, so the
+        returned DataFrame is indexed by `dti[1:]` and has one row per step.
+        Column 'dt' is the `dt` attribute of the feed at that step.
+        """
+        df = self.df
+        dti = pd.Index(dti)
+        feed_dt = dti[:-1].to_numpy(copy=True)
+        locs = df.index.get_indexer(feed_dt, method='ffill')
+        if len(locs):
+            feed_dt[0] = df.index[0]
+            locs[0] = 0
+        if (locs < 0).any():
+            raise IndexError(
+                f"no records before {feed_dt[np.argmax(locs < 0)]} exist in "
+                f"instance of {cls_name(self)}"
+            )
+        out = df.iloc[locs].set_axis(dti[1:], axis=0)
+        out['dt'] = feed_dt
+        return out
+
     def set_from_prev(self):
         """
         Set `self`'s attributes to the values of the next record where the
@@ -329,6 +496,14 @@ class FeedBase():
 
     @classmethod
     def to_datetime(cls, val: Any):
+        if isinstance(val, (pd.Series, np.ndarray)) and val.dtype.kind == 'i':
+            # Already int64 ns timestamps: skip parsing in `pd.to_datetime`
+            if getattr(cls, 'USE_NS_DT', False):
+                return val.astype(np.int64, copy=False)
+            as_dt = np.asarray(val, dtype=np.int64).view('datetime64[ns]')
+            if isinstance(val, pd.Series):
+                return pd.Series(as_dt, index=val.index, name=val.name)
+            return as_dt
         dt = pd.to_datetime(val)
         if dt is None:
             return None
@@ -370,6 +545,8 @@ class FeedBase():
         df.set_index('dt', inplace=True)
         df.sort_index(inplace=True)
         self._in_df = df
+        self._buf_n = 0
+        self._invalidate_records_cache()
         self.set_from_first()
 
     def record_from_df(self, df):
@@ -465,6 +642,7 @@ class PlotlyPlotter:
         labels: Optional[Dict] = None,
         names: Optional[Dict] = None,
         show: bool = False,
+        max_points: Optional[int] = 20_000,
     ):
         """
         Plot a pandas DataFrame `df` using Plotly Express, with x-axis
@@ -479,9 +657,18 @@ class PlotlyPlotter:
         If `only_numeric` is True, will only plot columns in the DataFrame
         with a numeric data type.
         Passing `show=False` will not show the figure.
+        If `in_df` has more than `max_points` rows, only every n-th row and
+        the last row are plotted, so that at most `max_points` + 1 rows are
+        plotted. Pass `max_points=None` to plot all rows.
         """
         if not in_df.index.name or in_df.index.name in ['index', ] + list(DATE_COLS):
             in_df.index.name = 'dt'
+        if max_points and len(in_df) > max_points:
+            stride = -(-len(in_df) // max_points)
+            rows = np.arange(0, len(in_df), stride)
+            if rows[-1] != len(in_df) - 1:
+                rows = np.append(rows, len(in_df) - 1)
+            in_df = in_df.iloc[rows]
         df = in_df.reset_index()
 
         if only_numeric:
@@ -631,7 +818,10 @@ class PositionBase(FeedBase, PlotlyPlotter):
             self.nshares = nshares
         assert not pd.isnull(self.nshares)
 
-        logger.log(self.logging_level, f"Opened position {pf(asdict(self))}")
+        # asdict recursively copies the tracked feed, so skip it unless the
+        # message will actually be logged.
+        if logger.isEnabledFor(self.logging_level):
+            logger.log(self.logging_level, f"Opened position {pf(asdict(self))}")
 
     def cost_to_open(self) -> float:
         """
@@ -657,7 +847,7 @@ class PositionBase(FeedBase, PlotlyPlotter):
         self.daily_returns = 0.
         self.daily_pct_returns = 0.
         self.is_open = 0
-        if log:
+        if log and logger.isEnabledFor(self.logging_level):
             logger.log(self.logging_level, f"Closed position {pf(asdict(self))}")
         # breakpoint()
         return self.value_at_close
@@ -941,6 +1131,32 @@ class StrategyBase(FeedBase, PlotlyPlotter):
             pos.record()
         self.record()
 
+    def _record_vectorized(self, records: pd.DataFrame, exit_value: float = 0.):
+        """
+        Load `records` returned by `step_vectorized` into `_in_df`, with the
+        same rows and columns as if `record` had been called at every step.
+        Fields that are not in `records` keep their current values.
+        `exit_value` is added to `cash_equity`, like the close value of
+        positions that `finish` closes at the end of `run`.
+        """
+        if records.empty:
+            self.cash_equity += exit_value
+            return
+        df = pd.DataFrame(index=self.clock.dti)
+        step_dti = df.index[1:]
+        for name in self._get_record_fields():
+            if name in records.columns:
+                col = records[name].set_axis(step_dti, axis=0)
+            else:
+                col = pd.Series(getattr(self, name), index=step_dti)
+            df[name] = col
+        self._in_df = df
+        self._buf_n = 0
+        self._invalidate_records_cache()
+        self._set_from_dict({col: records[col].iloc[-1] for col in records.columns})
+        self.cash_equity += exit_value
+        self.dt = step_dti[-1]
+
     def finish(self):
         """
         Runs after all steps in the backtest simulation are completed.
@@ -1186,44 +1402,96 @@ class BacktestEngine(object):
         Main event loop. Call this method to run the backtest simulation
         for all intervals of the main clock between `start_date` and `end_date`.
         """
+        self._run_loop(self._strats.values())
+
+    def run_vectorized(self):
+        """
+        Run the backtest simulation, stepping each strategy that implements
+        `step_vectorized` over all intervals of the main clock at once.
+        `step_vectorized` is passed a dict of the DataFrames returned by
+        `FeedBase.values_on_clock` for each feed, keyed by feed name, and
+        returns a DataFrame with one row of records per step, along with the
+        value of closing the positions that are still open after the last
+        step (see `StrategyBase._record_vectorized`). Feeds are set to their
+        values at the end of the run before `step_vectorized` is called, as
+        they would be when `finish` is called by `run`. Vectorized strategies
+        do not create `positions`. Remaining strategies run in the main
+        event loop first.
+        """
+        clock = self._clocks['main']
+        vec_strats = [
+            strat for strat in self._strats.values()
+            if _get_callable(strat, 'step_vectorized') is not None
+        ]
+        loop_strats = [
+            strat for strat in self._strats.values() if strat not in vec_strats
+        ]
+        if loop_strats:
+            self._run_loop(loop_strats)
+        if not vec_strats:
+            return
+
+        feed_values = {
+            feedn: feed.values_on_clock(clock.dti)
+            for feedn, feed in self._feeds.items()
+        }
+        if len(clock.dti) > 1:
+            for feed in self._feeds.values():
+                feed.dt = clock.dti[-1]
+                feed.set_from_prev_in_df()
+        for strat in vec_strats:
+            strat.feeds.update(self._feeds)
+            strat.clock = clock
+            strat.start()
+            strat._record_vectorized(*strat.step_vectorized(feed_values))
+            strat.finish()
+
+    def _run_loop(self, strats: List[StrategyBase]):
+        """Main event loop over strategies `strats`. See `run`."""
         # Pass all feeds and main clock to all strats
-        for strat in self._strats.values():
+        for strat in strats:
             strat.feeds.update(self._feeds)
             strat.clock = self._clocks['main']
             strat.start()
 
+        # Snapshot the containers so that `step` iterates over tuples
+        if any(clockn != 'main' for clockn in self._clocks):
+            raise NotImplementedError()
+        self._main_clock = self._clocks['main']
+        self._feed_items = tuple(self._feeds.items())
+        self._strat_items = tuple(
+            (strat, _get_callable(strat, 'pre_step'), _get_callable(strat, 'post_step'))
+            for strat in strats
+        )
+
         # Main do..while event loop
         self.step()
         while not pd.isnull(self.dt):
             self.step()
 
         # Run `finish` for all strategies
-        for strat in self._strats.values():
+        for strat in strats:
             strat.finish()
 
     def step(self):
         """Run at every step of the simulation."""
         # Tick main clock
-        for clockn, clock in self._clocks.items():
-            if clockn == 'main':
-                self.dt = clock.step()
-            else:
-                raise NotImplementedError()
+        self.dt = self._main_clock.step()
         if pd.isnull(self.dt):
             return
 
         # Iterate over strategies
-        for strat in self._strats.values():
+        for strat, pre_step, post_step in self._strat_items:
             strat._pre_step()
-            if isinstance(getattr(strat, 'pre_step', None), Callable):
-                strat.pre_step()
+            if pre_step is not None:
+                pre_step()
             strat.step()
-            if isinstance(getattr(strat, 'post_step', None), Callable):
-                strat.post_step()
+            if post_step is not None:
+                post_step()
             strat._post_step()
 
         # Update all feeds
-        for feedn, feed in self._feeds.items():
+        for feedn, feed in self._feed_items:
             feed.dt = self.dt
             feed.set_from_prev_in_df()
 
@@ -1271,6 +1539,75 @@ class BasicStrategy(StrategyBase):
             if pos.days_open >= 30:
                 self.close(pos)
 
+    def step_vectorized(self, feeds: Dict[str, pd.DataFrame]) -> Tuple[pd.DataFrame, float]:
+        """
+        Same as running `step` at every step, for `BacktestEngine.run_vectorized`.
+        The short position is never closed, so at most one is opened. Long
+        positions are opened and closed one at a time, so this loops over
+        long positions rather than steps. Positions still open after the
+        last step are closed at the price in the feed at the end of the run.
+        """
+        feed = feeds['price']
+        aapl = feed['AAPL'].to_numpy(dtype=float)
+        feed_dt = feed['dt'].to_numpy()
+        nshares = 100.
+        nlong = np.zeros(len(aapl), dtype=int)
+        nshort = np.zeros(len(aapl), dtype=int)
+        returns = np.zeros(len(aapl))
+        open_value = np.zeros(len(aapl))
+        cash_flows = np.zeros(len(aapl))
+        exit_price = self.feeds['price'].AAPL
+        exit_value = 0.
+
+        short_opens = np.flatnonzero(aapl > 1.2)
+        if len(short_opens):
+            i = short_opens[0]
+            held = slice(i, None)
+            nshort[held] = 1
+            returns[held] += nshares * (aapl[i] - aapl[held])
+            open_value[held] += nshares * (2 * aapl[i] - aapl[held])
+            cash_flows[i] -= nshares * aapl[i]
+            exit_value += nshares * (2 * aapl[i] - exit_price)
+
+        can_buy = aapl < 1.0
+        # Positions are closed after 30 days, but `days_open` is always -1
+        # if the feed uses int nanosecond timestamps
+        if feed_dt.dtype.kind == 'M':
+            month = np.timedelta64(30, 'D')
+        else:
+            month = None
+        i = np.argmax(can_buy) if can_buy.any() else len(aapl)
+        while i < len(aapl):
+            if month is None:
+                closes = np.array([], dtype=int)
+            else:
+                closes = np.flatnonzero(feed_dt[i + 1:] - feed_dt[i] >= month) + i + 1
+            j = closes[0] if len(closes) else len(aapl)
+            held = slice(i, j)
+            nlong[held] = 1
+            returns[held] += nshares * (aapl[held] - aapl[i])
+            open_value[held] += nshares * aapl[held]
+            cash_flows[i] -= nshares * aapl[i]
+            if j < len(aapl):
+                returns[j:] += nshares * (aapl[j] - aapl[i])
+                cash_flows[j] += nshares * aapl[j]
+            else:
+                exit_value += nshares * exit_price
+            # Can only buy again on the step after closing
+            next_buys = np.flatnonzero(can_buy[j + 1:])
+            i = next_buys[0] + j + 1 if len(next_buys) else len(aapl)
+
+        cash_equity = self.cash_equity + np.cumsum(cash_flows)
+        records = pd.DataFrame(dict(
+            value=open_value + cash_equity,
+            returns=returns,
+            cash_equity=cash_equity,
+            npositions=nlong + nshort,
+            nshort=nshort,
+            nlong=nlong,
+        ), index=feed.index)
+        return records, exit_value
+
 
 @dataclass
 class BuyAndHold(StrategyBase):
@@ -1372,14 +1709,18 @@ class BookFeed(FeedBase):
     Bid2SizeBillionths: int = 0
     Ask2SizeBillionths: int = 0
 
-def downsample_to_pow(val: int, pow10: int = 6) -> int:
-    n = pow10 + 1
-    hi, lo = str(val)[:-n], str(val)[-n:]
-    roundup = lambda x: int(ceil(x / 10.0)) * 10
-    suffix = str(roundup(int(lo[:2])))[0] + (pow10 * '0')
-    final = int(hi + suffix)
-    assert len(str(final)) == len(str(val))
-    return final
+def downsample_to_pow(
+    val: Union[int, np.ndarray], pow10: int = 6
+) -> Union[int, np.ndarray]:
+    """
+    Round integer timestamp(s) `val` up to the next multiple of 10**`pow10`,
+    ignoring any digits below 10**(`pow10` - 1). Accepts a scalar or an
+    array of int64 nanosecond timestamps, and operates on the whole array
+    at once.
+    """
+    assert pow10 >= 1, f"{pow10=} must be at least 1"
+    unit = 10 ** pow10
+    return (np.asarray(val, dtype=np.int64) // (unit // 10) + 9) // 10 * unit
 
 @dataclass
 class AccumulationStratBase(StrategyBase):
@@ -1397,11 +1738,8 @@ class AccumulationStratBase(StrategyBase):
         # If I want to achieve a 3% participation rate overall, what should I set my target rate to?
 
         df = self.last_n_trades(5)
-        df['dt_ds'] = (
-            pd.Series(df.index, dtype=np.int64)
-            .apply(downsample_to_pow, args=[self.qualifying_reaction_time_pow10])
-            .values
-        )
+        df['dt_ds'] = downsample_to_pow(
+            df.index.values.astype(np.int64), self.qualifying_reaction_time_pow10)
 
         price_func = 'min' if self.side < 0 else 'max'
         grp = df.groupby('dt_ds', group_keys=False).apply(self._mark_qualified)
@@ -0,0 +1,127 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+from accumulate import AccumulateRunner, InsufficientRowsError, mark_qualified
+from ubacktester import downsample_to_pow
+
+TRADES_CSV = os.path.realpath('tests/data/mini_trades_narrow_BTC-USD_2021.delim')
+
+
+@pytest.mark.skipif(
+    not os.path.isfile(TRADES_CSV),
+    reason="requires tests/data/*.delim files"
+)
+class TestAccumulate:
+
+    @pytest.fixture(autouse=True)
+    def _memoize_in_tmp_path(self, tmp_path, monkeypatch):
+        # `memoize_feather` writes to data/memoize relative to the cwd
+        monkeypatch.chdir(tmp_path)
+
+    def _get_trades(self, side):
+        df = pd.read_csv(TRADES_CSV, sep='\t')
+        df = df.rename(columns={'timestamp_utc_nanoseconds': 'dt'})
+        df = df.sort_values(by='dt', kind='stable').reset_index(drop=True)
+        df['Side'] = df['Side'].replace(0, -side).astype(int)
+        return df
+
+    @pytest.mark.parametrize('side', [1, -1])
+    @pytest.mark.parametrize('pow10', [6, 8])
+    def test_mark_qualified(self, side, pow10):
+        df = self._get_trades(side)
+        df['side_sign'] = np.sign(df['Side'])
+        dt_ds, is_qual = mark_qualified(
+            ts=df['dt'].to_numpy(np.int64),
+            side_sign=df['side_sign'].to_numpy(),
+            price=df['PriceMillionths'].to_numpy(np.int64),
+            pow10=pow10,
+        )
+
+        # Reference: max price for buys and min price for sells, per bucket
+        df['dt_ds'] = downsample_to_pow(df['dt'].to_numpy(np.int64), pow10)
+        grp = df.groupby(['dt_ds', 'side_sign'])['PriceMillionths']
+        best = np.where(df['side_sign'] > 0, grp.transform('max'), grp.transform('min'))
+        np.testing.assert_array_equal(dt_ds, df['dt_ds'])
+        np.testing.assert_array_equal(is_qual, (df['PriceMillionths'] == best).astype(np.int8))
+
+    @pytest.mark.parametrize('start_date_ns,row_limit', [
+        (1618100000000000000, 100),
+        (0, 5000),
+    ])
+    def test_read_trades_window(self, start_date_ns, row_limit):
+        runner = AccumulateRunner(side=1, downsample_rate=6)
+        nrows = len(pd.read_csv(TRADES_CSV, sep='\t'))
+        tbl, is_full = runner._read_trades_window(
+            TRADES_CSV, start_date_ns, row_limit, pow10=6)
+        assert not is_full and tbl.num_rows < nrows // 2
+
+        # Trades near the edges of the window are marked the same as when
+        # marking the whole file
+        df = runner.get_trades_data(
+            fp=TRADES_CSV, downsample_rate=6, side=1,
+            start_date_ns=start_date_ns, row_limit=row_limit,
+        )
+        full = runner._load_and_mark(fp=TRADES_CSV, downsample_rate=6, side=1)
+        assert len(df) == row_limit
+        pd.testing.assert_frame_equal(df, full.loc[start_date_ns:].iloc[:row_limit])
+
+    def test_mark_qualified_trades_pow10(self):
+        df = self._get_trades(side=1).set_index('dt')
+        runner = AccumulateRunner(side=1, downsample_rate=0)
+        with pytest.raises(AssertionError):
+            runner.mark_qualified_trades(df)
+
+    @pytest.mark.parametrize('side', [1, -1])
+    def test_run_accumulate_strat(self, side):
+        target_notional = 1e4
+        runner = AccumulateRunner(side=side, downsample_rate=6)
+        df = runner.run_accumulate_strat(
+            TRADES_CSV, target_notional=target_notional, row_limit=1e5,
+            target_prt_rate=0.01,
+        )
+        size = df['SizeBillionths'].to_numpy()
+        same_side = df['Side'].to_numpy() * side > 0
+        is_qual = same_side & (df['is_qual'].to_numpy() != 0)
+        np.testing.assert_array_equal(df['cum_volm_side'], np.where(same_side, size, 0).cumsum())
+        np.testing.assert_array_equal(df['cum_volm_opp'], np.where(~same_side, size, 0).cumsum())
+        np.testing.assert_array_equal(df['cum_volm_qual'], np.where(is_qual, size, 0).cumsum())
+        np.testing.assert_array_equal(df['cum_volm_all'], size.cumsum())
+
+        # Stops at the first trade that takes notional past the target,
+        # along with any trades at the same dt
+        past_target = df['notional_cumsum'].to_numpy() > target_notional * 1e9
+        assert past_target.any()
+        assert df.index[np.argmax(past_target)] == df.index[-1]
+
+    def test_run_accumulate_strat_no_trades(self):
+        runner = AccumulateRunner(side=1, downsample_rate=6)
+        with pytest.raises(InsufficientRowsError):
+            runner.run_accumulate_strat(TRADES_CSV, start_date='2030-01-01')
+
+    def test_trades_cache_reused_across_windows(self, monkeypatch):
+        nreads = list()
+
+        def count_reads(read):
+            def with_count(cls, *args, **kw):
+                nreads.append(1)
+                return read(*args, **kw)
+            return classmethod(with_count)
+
+        for name in ('_read_trades_csv', '_read_trades_window'):
+            monkeypatch.setattr(
+                AccumulateRunner, name, count_reads(getattr(AccumulateRunner, name)))
+
+        runner = AccumulateRunner(side=1, downsample_rate=6)
+        kw = dict(target_notional=1e3, target_prt_rate=0.01)
+        runner.run_accumulate_strat(TRADES_CSV, row_limit=1e5, **kw)
+        assert len(nreads) == 1
+        assert len(os.listdir('data/memoize')) == 1
+        # Windows with any other start_date and row_limit reuse the same
+        # cached trades, which were marked over the whole file
+        df = runner.run_accumulate_strat(
+            TRADES_CSV, start_date='2021-04-11', row_limit=5e4, **kw)
+        assert len(nreads) == 1
+        assert len(os.listdir('data/memoize')) == 1
+        full = runner._load_and_mark(fp=TRADES_CSV, downsample_rate=6, side=1)
+        np.testing.assert_array_equal(df['is_qual'], full.loc[df.index[0]:df.index[-1], 'is_qual'])
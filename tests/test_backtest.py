@@ -1,11 +1,13 @@
 import os
 import pytest
+import numpy as np
 import pandas as pd
 import ast
 import plotly.express as px
 from ubacktester import (
     PriceFeed, BacktestEngine, BasicStrategy, px_plot, BuyAndHold,
     NaiveQuantileStrat, ClockBase, AccumulationStratBase, TradesFeed, BookFeed,
+    downsample_to_pow, RECORD_BUFFER_SIZE,
 )
 from profiler import profiler
 
@@ -42,6 +44,63 @@ class TestPriceFeed:
         # Can plot using plotly express
         ps.plot(show=False)
 
+    def test_get_prev_next(self):
+        df = pd.DataFrame({
+            'date': ['2021-01-01', '2021-01-03', '2021-01-05'],
+            'price': [3., 4., 5.],
+        })
+        ps = PriceFeed.from_df(df)
+        ps.dt = pd.to_datetime('2021-01-04')
+        assert ps.get_prev()['price'] == 4.
+        assert ps.get_next()['price'] == 5.
+        ps.dt = pd.to_datetime('2021-01-05')
+        assert ps.get_prev()['price'] == 5.
+        assert ps.get_next()['price'] == 5.
+        ps.dt = pd.to_datetime('2020-12-31')
+        with pytest.raises(AssertionError):
+            ps.get_prev()
+
+    def _get_clocked_feed(self, periods):
+        dti = pd.date_range('2021-01-01', periods=periods)
+        ps = PriceFeed(dti[0], float('nan'))
+        ps.clock = ClockBase(dti)
+        return ps, dti
+
+    def test_record_none_keeps_float_dtype(self):
+        ps, dti = self._get_clocked_feed(10)
+        for i in range(5):
+            ps.dt = dti[i]
+            ps.price = float(i)
+            ps.record()
+        assert ps.df['price'].dtype == np.float64
+        ps.dt = dti[5]
+        ps.price = None
+        ps.record()
+        assert ps.df['price'].dtype == np.float64
+        assert np.isnan(ps.df.loc[dti[5], 'price'])
+
+    def test_record_past_buffer_size(self):
+        nrecords = 2 * RECORD_BUFFER_SIZE + 10
+        ps, dti = self._get_clocked_feed(nrecords)
+        for i in range(nrecords):
+            ps.dt = dti[i]
+            ps.price = float(i)
+            ps.record()
+        np.testing.assert_array_equal(ps.df['price'], np.arange(nrecords, dtype=float))
+        assert ps.df.index.equals(dti)
+
+    def test_plot_max_points(self):
+        df = pd.DataFrame({
+            'date': pd.date_range('2021-01-01', periods=1001, freq='min'),
+            'price': np.arange(1001.),
+        })
+        ps = PriceFeed.from_df(df)
+        fig = ps.plot(show=False, max_points=100)
+        assert len(fig.data[0].x) <= 101
+        assert fig.data[0].y[-1] == 1000.
+        fig = ps.plot(show=False, max_points=None)
+        assert len(fig.data[0].x) == 1001
+
     @pytest.mark.skip
     def test_set_from_dataframe(self):
         df = px.data.stocks()
@@ -61,10 +120,56 @@ class TestPriceFeed:
         ps.get_prev()
 
 
+class TestDownsample:
+
+    def test_downsample_to_pow(self):
+        ts = np.array([
+            1618090132515484000, # round up
+            1618090132510000000, # already on a boundary
+            1618090132510099999, # digits below 1e5 are ignored
+            1618090132989553000, # carries into the next 1e7 digit
+        ], dtype=np.int64)
+        expected = np.array([
+            1618090132516000000,
+            1618090132510000000,
+            1618090132510000000,
+            1618090132990000000,
+        ], dtype=np.int64)
+        np.testing.assert_array_equal(downsample_to_pow(ts, 6), expected)
+        assert downsample_to_pow(int(ts[0]), 6) == expected[0]
+
+
 class TestRunStrategy:
     HW3_QUANTILES_CSV = 'tests/data/hw3_quantiles.csv'
     HW3_PRICES_CSV = 'tests/data/hw3_prices.csv'
 
+    @pytest.mark.parametrize('engine_kw', [
+        dict(start_date='2018-01-01', end_date='2019-12-01', step_size='1D'),
+        dict(start_date='2018-01-01', end_date='2019-12-01', step_size='3D'),
+        dict(clock=ClockBase(pd.DatetimeIndex(['2018-06-01']))),
+    ])
+    def test_run_vectorized(self, engine_kw):
+        strats = list()
+        for vectorized in (False, True):
+            be = BacktestEngine(**engine_kw)
+            be.add_feed(PriceFeed.from_df(px.data.stocks()), name='price')
+            strat = BasicStrategy(cash_equity=200.)
+            be.add_strategy(strat)
+            if vectorized:
+                be.run_vectorized()
+            else:
+                be.run()
+            strats.append(strat)
+        loop_strat, vec_strat = strats
+        assert not vec_strat.positions
+        for name in ('cash_equity', 'value', 'returns', 'npositions', 'nshort', 'nlong'):
+            assert getattr(vec_strat, name) == pytest.approx(getattr(loop_strat, name)), name
+        if loop_strat.positions:
+            pd.testing.assert_frame_equal(loop_strat.df, vec_strat.df)
+        else:
+            assert not hasattr(loop_strat, '_in_df')
+            assert not hasattr(vec_strat, '_in_df')
+
     def test_run_basic_strategy(self):
         be = BacktestEngine(
             start_date='2018-01-01',
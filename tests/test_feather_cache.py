@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+from feather_cache import memoize_feather
+
+
+class TestMemoizeFeather:
+
+    def test_memoize(self, tmp_path):
+        cache_dir = str(tmp_path / 'memoize')
+        fp = str(tmp_path / 'in.csv')
+        pd.DataFrame({'dt': [3, 1, 2], 'price': [1., 2., 3.]}).to_csv(fp, index=False)
+        ncalls = list()
+
+        @memoize_feather(cache_dir=cache_dir)
+        def read(fp, row_limit=10):
+            ncalls.append(1)
+            return pd.read_csv(fp).set_index('dt').sort_index().iloc[:row_limit]
+
+        df = read(fp, row_limit=2)
+        cached = read(fp, row_limit=2)
+        assert len(ncalls) == 1
+        pd.testing.assert_frame_equal(df, cached)
+
+        # Different arguments are cached separately
+        read(fp, row_limit=1)
+        assert len(ncalls) == 2
+
+        # Modifying the input file invalidates the cache
+        mtime = os.path.getmtime(fp) + 10
+        os.utime(fp, (mtime, mtime))
+        read(fp, row_limit=2)
+        assert len(ncalls) == 3
+
+    def test_write_cache(self, tmp_path):
+        cache_dir = str(tmp_path / 'memoize')
+        ncalls = list()
+
+        @memoize_feather(cache_dir=cache_dir)
+        def make(n):
+            ncalls.append(1)
+            return pd.DataFrame({'x': range(n)})
+
+        assert not os.path.isfile(make.cache_path(3))
+        df = pd.DataFrame({'x': [7, 8, 9]})
+        make.write_cache(df, n=3)
+        assert os.path.isfile(make.cache_path(3))
+        pd.testing.assert_frame_equal(make(3), df)
+        assert not ncalls